@@ -1,82 +1,253 @@
 import os
 import json # 匯入 json 模組
-from openai import AzureOpenAI
-from qdrant_client import QdrantClient
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from functools import lru_cache
+import numpy as np
+import orjson
 from flask import Flask, render_template, request, jsonify, Response # 匯入 Response
-from dotenv import load_dotenv
+# Azure OpenAI 與 Qdrant 的設定與 Client 都在 clients.py，gunicorn worker 啟動後 (見 gunicorn.conf.py) 或第一次搜尋時才匯入並建立
+from clients import AZURE_OPENAI_EMBEDDING_DEPLOYMENT, get_openai, get_qdrant
 
 # --- 設定 ---
-load_dotenv()
+COLLECTION_NAME = "taiwan_food_menu_azure"
 
-# Azure OpenAI 設定
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
-AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
-AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+# 語意快取設定
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache.sqlite")
+SEMANTIC_CACHE_THRESHOLD = 0.97   # 與快取查詢的餘弦相似度達此門檻即直接沿用結果
+SEMANTIC_CACHE_TTL_SECONDS = 3600 # 重新遷移後避免沿用過舊的結果
+SEMANTIC_CACHE_MAX_ENTRIES = 256  # 只保留最近 K 筆查詢 (FIFO)
+SEMANTIC_CACHE_PRUNE_EVERY = 32   # 每寫入 N 筆才淘汰一次過期與超出上限的項目，不必每次寫入都在鎖內執行 DELETE
 
-# Qdrant 設定
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-COLLECTION_NAME = "taiwan_food_menu_azure"
+# 連線設定
+AZURE_KEEPALIVE_ENABLED = os.getenv("AZURE_KEEPALIVE_ENABLED", "true").lower() == "true"
+AZURE_KEEPALIVE_INTERVAL_SECONDS = 40 # Azure 閒置約 60 秒就會關閉連線，定期 ping 保持 TLS 連線
 
 # --- 初始化 ---
+# print 每次都會取得全域鎖並同步寫入 stdout，搜尋路徑上改用 logging；設定 LOG_LEVEL=DEBUG 可看到每次搜尋的細節
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
 # 雖然我們將手動處理，但保留此設定是個好習慣
 app.config['JSON_AS_ASCII'] = False
 
-openai_client = None
-qdrant_client = None
+POINT_COUNT = None     # 第一次確認時取得的資料點數量，僅供日誌參考
+COLLECTION_OK = False  # Collection 是否可用；只有在尚未確認、不可用或搜尋失敗時才重新確認
 
-# 初始化 Azure OpenAI Client
-try:
-    if all([AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY, AZURE_OPENAI_EMBEDDING_DEPLOYMENT, AZURE_OPENAI_API_VERSION]):
-        openai_client = AzureOpenAI(
-            api_key=AZURE_OPENAI_API_KEY, api_version=AZURE_OPENAI_API_VERSION, azure_endpoint=AZURE_OPENAI_ENDPOINT
-        )
-        print("✅ 成功初始化 Azure OpenAI Client。")
-    else:
-        print("⚠️ 警告：Azure OpenAI 的環境變數不完整。")
-except Exception as e:
-    print(f"❌ 初始化 Azure OpenAI Client 失敗: {e}")
+# 確認 Collection 狀態只做一次 (gunicorn worker 在接受請求前先確認，其他情況在第一次搜尋時)，不佔用之後每次搜尋的 Qdrant 往返
+def _probe_collection():
+    global POINT_COUNT, COLLECTION_OK
+    try:
+        POINT_COUNT = get_qdrant().get_collection(COLLECTION_NAME).points_count
+        COLLECTION_OK = True
+        logger.info("✅ Collection '%s' 共有 %s 個資料點。", COLLECTION_NAME, POINT_COUNT)
+    except Exception as e:
+        COLLECTION_OK = False
+        logger.warning("⚠️ 警告：無法取得 Collection '%s': %s", COLLECTION_NAME, e)
+    return COLLECTION_OK
 
-# 初始化 Qdrant Client
+# 背景定期送出輕量的 embedding 請求，避免 Azure 連線閒置被關閉後，
+# 下一位使用者要重新付出 TCP/TLS 握手的冷啟動延遲。
+# 每次 ping 都會計費，因此不在匯入時啟動，只由實際提供服務的行程呼叫 start_azure_keepalive()
+# (gunicorn worker 由 gunicorn.conf.py 的 post_worker_init 啟動，本機開發則在 __main__ 啟動)
+_keepalive_started = False
+
+def _keep_azure_connection_warm():
+    openai_client = get_openai()
+    if not openai_client:
+        return
+    try:
+        openai_client.embeddings.create(input="ping", model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+    except Exception as e:
+        logger.warning("⚠️ Azure keep-alive 失敗: %s", e)
+    _schedule_azure_keepalive()
+
+def _schedule_azure_keepalive():
+    timer = threading.Timer(AZURE_KEEPALIVE_INTERVAL_SECONDS, _keep_azure_connection_warm)
+    timer.daemon = True
+    timer.start()
+
+def start_azure_keepalive():
+    """在提供服務的行程中啟動 Azure keep-alive；設定 AZURE_KEEPALIVE_ENABLED=false 可關閉，重複呼叫不會重複啟動。"""
+    global _keepalive_started
+    if not AZURE_KEEPALIVE_ENABLED or _keepalive_started:
+        return
+    _keepalive_started = True
+    _schedule_azure_keepalive()
+
+# 初始化語意快取 (sqlite)，失敗時僅停用快取，不影響搜尋
+semantic_cache_db = None
+semantic_cache_lock = threading.Lock()
+_semantic_cache_inserts = 0 # 距離上次淘汰後寫入的筆數，受 semantic_cache_lock 保護
 try:
-    if all([QDRANT_URL, QDRANT_API_KEY]):
-        qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-        print("✅ 成功連線到 Qdrant。")
-    else:
-        print("⚠️ 警告：Qdrant 的環境變數不完整。")
+    semantic_cache_db = sqlite3.connect(SEMANTIC_CACHE_PATH, check_same_thread=False)
+    semantic_cache_db.execute(
+        "CREATE TABLE IF NOT EXISTS semantic_cache ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, embedding BLOB NOT NULL, "
+        "found_items TEXT NOT NULL, created_at REAL NOT NULL)"
+    )
+    semantic_cache_db.commit()
+    logger.info("✅ 成功初始化語意快取。")
 except Exception as e:
-    print(f"❌ Qdrant 連線失敗: {e}")
+    semantic_cache_db = None
+    logger.warning("⚠️ 警告：語意快取初始化失敗，將停用快取: %s", e)
+
+# --- 查詢向量快取 ---
+# 使用者常重複輸入相同的短字串，以正規化後的查詢字串為 key 快取向量，
+# 重複查詢就不必再呼叫一次 Azure。lru_cache 不會快取拋出例外的呼叫，
+# 所以 Azure 暫時失敗時不會把錯誤結果存進快取。
+@lru_cache(maxsize=4096)
+def _embed(query: str) -> np.ndarray:
+    response = get_openai().embeddings.create(input=query, model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    # 與遷移時相同，正規化為單位向量後搭配 Collection 的 DOT 距離 (等同餘弦相似度)
+    vector /= np.linalg.norm(vector)
+    vector.setflags(write=False) # 快取中的陣列會被共用，設為唯讀避免被意外修改
+    return vector
+
+# --- 語意快取 ---
+# 相近的查詢 (例如「牛肉麵」與「牛肉 麵」) 直接沿用先前的 Qdrant 結果，
+# 省下 Qdrant 的搜尋往返。查詢向量已正規化為單位長度，內積即為餘弦相似度。
+def _semantic_cache_lookup(query_vector):
+    # 快取只是加速用，sqlite 出錯 (例如多個 worker 同時寫入造成 database is locked) 時視為未命中
+    if semantic_cache_db is None:
+        return None
+    try:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        with semantic_cache_lock:
+            rows = semantic_cache_db.execute(
+                "SELECT embedding, found_items FROM semantic_cache WHERE created_at >= ? AND length(embedding) = ?",
+                (time.time() - SEMANTIC_CACHE_TTL_SECONDS, vector.nbytes)
+            ).fetchall()
+        if not rows:
+            return None
+
+        cached_vectors = np.frombuffer(b"".join(row[0] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        similarities = cached_vectors @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        return json.loads(rows[best][1]), float(similarities[best])
+    except Exception as e:
+        logger.warning("⚠️ 語意快取查詢失敗，視為未命中: %s", e)
+        return None
+
+def _semantic_cache_store(query_vector, found_items):
+    # 寫入失敗只略過這次快取，不影響已經成功的搜尋結果
+    global _semantic_cache_inserts
+    if semantic_cache_db is None:
+        return
+    vector = np.asarray(query_vector, dtype=np.float32)
+    now = time.time()
+    with semantic_cache_lock:
+        try:
+            semantic_cache_db.execute(
+                "INSERT INTO semantic_cache (embedding, found_items, created_at) VALUES (?, ?, ?)",
+                (vector.tobytes(), json.dumps(found_items, ensure_ascii=False), now)
+            )
+            # 每 SEMANTIC_CACHE_PRUNE_EVERY 筆才淘汰過期的項目，並只保留最近的 SEMANTIC_CACHE_MAX_ENTRIES 筆；
+            # 兩次淘汰之間多出的項目仍受查詢時的 TTL 條件限制，不會回傳過期的結果
+            _semantic_cache_inserts += 1
+            if _semantic_cache_inserts >= SEMANTIC_CACHE_PRUNE_EVERY:
+                semantic_cache_db.execute("DELETE FROM semantic_cache WHERE created_at < ?", (now - SEMANTIC_CACHE_TTL_SECONDS,))
+                semantic_cache_db.execute(
+                    "DELETE FROM semantic_cache WHERE id NOT IN (SELECT id FROM semantic_cache ORDER BY id DESC LIMIT ?)",
+                    (SEMANTIC_CACHE_MAX_ENTRIES,)
+                )
+                _semantic_cache_inserts = 0
+            semantic_cache_db.commit()
+        except Exception as e:
+            logger.warning("⚠️ 語意快取寫入失敗，略過這次快取: %s", e)
+            try:
+                semantic_cache_db.rollback()
+            except Exception:
+                pass
+
+# --- 核心搜尋函式 ---
+def _is_transport_error(e):
+    import grpc
+    import httpx
+    from qdrant_client.http.exceptions import ResponseHandlingException
+
+    if isinstance(e, grpc.RpcError):
+        return getattr(e, "code", lambda: None)() == grpc.StatusCode.UNAVAILABLE
+    return isinstance(e, (httpx.TransportError, ResponseHandlingException))
+
+def _search_qdrant(qdrant_client, query_vector):
+    from qdrant_client import models # 延後匯入，worker 啟動時不必載入 qdrant_client
+
+    def _search():
+        # qdrant-client 1.16 起已移除 search()，改用 query_points() 並取出 .points
+        return qdrant_client.query_points(
+            collection_name=COLLECTION_NAME,
+            query=query_vector,
+            limit=1,
+            score_threshold=0.65,
+            with_payload=["item_name"], # 只取回需要的欄位，減少傳輸量
+            # 先用 int8 量化向量快速搜尋，再以原始向量重新評分，維持準確度
+            search_params=models.SearchParams(
+                quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+            )
+        ).points
+
+    try:
+        return _search()
+    except Exception as e:
+        # 只有連線層級的錯誤才重新確認 Collection 後再試一次；
+        # 向量維度不符、請求格式錯誤等固定會失敗的錯誤直接拋出，不浪費額外的 RPC
+        if not _is_transport_error(e) or not _probe_collection():
+            raise
+        return _search()
+
+def _is_blank_query(query):
+    # 空白、標點符號或控制字元組成的查詢沒有可搜尋的內容
+    return all(unicodedata.category(ch)[0] in "ZPC" for ch in query)
 
-# --- 核心搜尋函式 (保持不變) ---
 def search_similar_item(query):
+    # 空白或只有標點的查詢直接略過，不呼叫 Azure 與 Qdrant
+    query = query.strip() if isinstance(query, str) else ""
+    if _is_blank_query(query):
+        return [], "略過：查詢內容為空白或只有標點符號"
+
+    openai_client, qdrant_client = get_openai(), get_qdrant()
     if not openai_client or not qdrant_client:
         return "錯誤：後端服務未完全初始化。", "Client 初始化失敗"
+    if not COLLECTION_OK and not _probe_collection():
+        return "錯誤：Qdrant Collection 無法使用。", f"無法取得 Collection '{COLLECTION_NAME}'"
 
     try:
-        # 1. 產生查詢向量
-        response = openai_client.embeddings.create(input=query, model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
-        query_vector = response.data[0].embedding
+        # 1. 產生查詢向量 (相同查詢直接取用快取)
+        query_vector = _embed(query.lower())
+
+        # 相近的查詢已經搜尋過，直接沿用快取結果
+        cached = _semantic_cache_lookup(query_vector)
+        if cached is not None:
+            found_items, similarity = cached
+            logger.debug("語意快取命中: %s (相似度: %.4f)", query, similarity)
+            # 快取中的分數是 Qdrant 針對先前那個查詢算出的，不能當成這次查詢的相似度，因此不回傳
+            found_items = [{"name": item["name"], "score": None} for item in found_items]
+            return found_items, f"語意快取命中 (與快取查詢的相似度: {similarity:.4f})"
 
         # 2. 在 Qdrant 搜尋
         # ★★★ 修正點：將 limit 改為 1，只找出最相關的一筆結果 ★★★
-        search_result = qdrant_client.search(
-            collection_name=COLLECTION_NAME,
-            query_vector=query_vector,
-            limit=1,
-            score_threshold=0.65
-        )
+        search_result = _search_qdrant(qdrant_client, query_vector)
 
         # 3. 整理結果
         found_items = [{"name": hit.payload.get("item_name"), "score": hit.score} for hit in search_result]
+        # 所有結果合併成一行日誌，而不是每筆結果各寫一次
+        logger.debug("Qdrant 搜尋完成: %s -> %s", query, found_items)
+        _semantic_cache_store(query_vector, found_items)
         log = f"Qdrant 原始回傳: {search_result}"
         return found_items, log
 
     except Exception as e:
         error_message = f"搜尋時發生嚴重錯誤: {type(e).__name__}"
         error_log = f"錯誤詳情: {str(e)}"
-        print(f"❌ 搜尋錯誤: {error_log}")
+        logger.error("❌ 搜尋錯誤: %s", error_log)
         return error_message, error_log
 
 # --- Flask 路由 ---
@@ -97,15 +268,15 @@ def index():
 def api_search():
     data = request.get_json()
     if not data or 'query' not in data:
-        error_response = json.dumps({'error': '請求內容缺少 "query" 欄位'}, ensure_ascii=False)
-        return Response(error_response, mimetype='application/json; charset=utf-8', status=400)
+        error_response = orjson.dumps({'error': '請求內容缺少 "query" 欄位'})
+        return Response(error_response, mimetype='application/json', status=400)
 
     query = data['query']
     results, log = search_similar_item(query)
 
     if isinstance(results, str) and "錯誤" in results:
-        error_response = json.dumps({'error': results, 'log': log}, ensure_ascii=False)
-        return Response(error_response, mimetype='application/json; charset=utf-8', status=500)
+        error_response = orjson.dumps({'error': results, 'log': log})
+        return Response(error_response, mimetype='application/json', status=500)
 
     # ★★★ 修正點：處理單一回傳結果 ★★★
     # 從結果列表中取出第一個項目，如果列表是空的，則回傳 null
@@ -116,12 +287,14 @@ def api_search():
         'query': query,
         'result': single_result # 將 'results' 列表改為 'result' 物件
     }
-    # 使用 json.dumps 將 python dict 轉換為 JSON 字串，並確保中文不被跳脫
-    json_response = json.dumps(response_data, ensure_ascii=False)
+    # orjson 直接輸出 UTF-8 編碼的 bytes，中文不會被跳脫，也不需要再另外 encode
+    json_response = orjson.dumps(response_data)
     
-    # 建立一個 Response 物件，並明確指定 mimetype 和 charset
-    return Response(json_response, mimetype='application/json; charset=utf-8')
+    # JSON 規範即為 UTF-8，不需要額外指定 charset
+    return Response(json_response, mimetype='application/json')
 
 # --- 啟動伺服器 ---
+# 僅供本機開發使用 (設定 FLASK_DEBUG=1 開啟除錯模式)；正式環境請用 gunicorn --config gunicorn.conf.py app:app
 if __name__ == '__main__':
-    app.run(debug=True)
+    start_azure_keepalive()
+    app.run()
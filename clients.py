@@ -0,0 +1,96 @@
+import os
+import threading
+from dotenv import load_dotenv
+
+# --- 設定 ---
+# app.py 與遷移腳本共用的環境變數與 Client。
+# openai / qdrant_client 的匯入相當耗時，因此延後到第一次呼叫 get_openai() / get_qdrant() 時才匯入並建立，
+# gunicorn worker 在 post_worker_init 中、接受請求之前先建立 (見 gunicorn.conf.py)，只匯入模組的 CLI 與遷移腳本則不必等待這些套件載入。
+load_dotenv()
+
+# Azure OpenAI 設定
+AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
+AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+
+# Qdrant 設定
+QDRANT_URL = os.getenv("QDRANT_URL")
+QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true" # gRPC 省去 REST 的協定與 pydantic 驗證開銷
+
+# 連線設定：共用 100 條 keep-alive 連線
+HTTP_POOL_SIZE = 100
+CLIENT_TIMEOUT_SECONDS = 30
+
+_clients = {}
+_clients_lock = threading.Lock()
+_qdrant_uses_grpc = False # gRPC 連接埠不可用而改用 REST 時為 False
+
+def _get_or_create(name, factory):
+    # 建立失敗時也會記住 None，避免每次呼叫都重試並重複印出錯誤
+    if name not in _clients:
+        with _clients_lock:
+            if name not in _clients:
+                _clients[name] = factory()
+    return _clients[name]
+
+def _http_pool_limits():
+    import httpx
+    return httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+
+def _create_openai():
+    try:
+        if not all([AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_API_KEY, AZURE_OPENAI_EMBEDDING_DEPLOYMENT, AZURE_OPENAI_API_VERSION]):
+            print("⚠️ 警告：Azure OpenAI 的環境變數不完整。")
+            return None
+        import httpx
+        from openai import AzureOpenAI
+        client = AzureOpenAI(
+            api_key=AZURE_OPENAI_API_KEY, api_version=AZURE_OPENAI_API_VERSION, azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            http_client=httpx.Client(limits=_http_pool_limits(), timeout=CLIENT_TIMEOUT_SECONDS)
+        )
+        print("✅ 成功初始化 Azure OpenAI Client。")
+        return client
+    except Exception as e:
+        print(f"❌ 初始化 Azure OpenAI Client 失敗: {e}")
+        return None
+
+def _create_qdrant():
+    global _qdrant_uses_grpc
+    try:
+        if not all([QDRANT_URL, QDRANT_API_KEY]):
+            print("⚠️ 警告：Qdrant 的環境變數不完整。")
+            return None
+        from qdrant_client import QdrantClient
+        if QDRANT_PREFER_GRPC:
+            try:
+                client = QdrantClient(
+                    url=QDRANT_URL, api_key=QDRANT_API_KEY, prefer_grpc=True,
+                    timeout=CLIENT_TIMEOUT_SECONDS, limits=_http_pool_limits()
+                )
+                # gRPC 連線是延遲建立的，先送一次請求確認 gRPC 連接埠可用
+                client.get_collections()
+                _qdrant_uses_grpc = True
+                print("✅ 成功連線到 Qdrant (gRPC)。")
+                return client
+            except Exception as e:
+                print(f"⚠️ Qdrant gRPC 連線失敗，改用 REST: {e}")
+        client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY, timeout=CLIENT_TIMEOUT_SECONDS, limits=_http_pool_limits())
+        print("✅ 成功連線到 Qdrant (REST)。")
+        return client
+    except Exception as e:
+        print(f"❌ Qdrant 連線失敗: {e}")
+        return None
+
+def get_openai():
+    """回傳共用的 Azure OpenAI Client，第一次呼叫時才建立；環境變數不完整或建立失敗時回傳 None。"""
+    return _get_or_create("openai", _create_openai)
+
+def get_qdrant():
+    """回傳共用的 Qdrant Client (優先使用 gRPC)，第一次呼叫時才建立；環境變數不完整或建立失敗時回傳 None。"""
+    return _get_or_create("qdrant", _create_qdrant)
+
+def qdrant_uses_grpc():
+    """回傳 get_qdrant() 的 Client 是否可以使用 gRPC；設定 QDRANT_PREFER_GRPC=false 或 gRPC 連線失敗改用 REST 時為 False。"""
+    return get_qdrant() is not None and _qdrant_uses_grpc
@@ -0,0 +1,29 @@
+import os
+
+# --- Gunicorn 設定 ---
+# 用法: gunicorn --config gunicorn.conf.py app:app
+
+# 監聽 Cloud Run 自動提供的連接埠
+bind = f":{os.getenv('PORT', '8080')}"
+timeout = 0
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+
+# 搜尋幾乎都在等待 Azure 與 Qdrant 的網路回應，適合用 gevent 以少量 worker 撐起大量同時連線。
+# 但 gRPC 與 gevent 的 monkey patch 不相容，Qdrant 使用 gRPC (預設) 時改用 gthread 執行緒 worker。
+if os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true":
+    worker_class = "gthread"
+    threads = int(os.getenv("GUNICORN_THREADS", "32"))
+else:
+    worker_class = "gevent"
+    worker_connections = 1000
+
+# 每個 worker 載入 app 之後、開始接受請求之前先建立 Client 並確認 Collection，
+# 第一位使用者不必等待 SDK 匯入、gRPC 探測與 get_collection()；flask CLI、測試仍在第一次搜尋時才建立。
+# Azure keep-alive 也只在這裡啟動，避免只是匯入 app 的行程也在背景持續送出計費的 ping
+def post_worker_init(worker):
+    import app
+    from clients import get_openai, get_qdrant
+    get_openai()
+    if get_qdrant():
+        app._probe_collection()
+    app.start_azure_keepalive()
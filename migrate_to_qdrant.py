@@ -1,19 +1,37 @@
 import os
-import uuid
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pyodbc
 import mysql.connector
 import google.generativeai as genai
-from qdrant_client import QdrantClient, models
-from dotenv import load_dotenv
+from qdrant_client import grpc, models
+# Qdrant 的設定與 Client 與 app.py 共用 clients.py (匯入時會載入 .env)
+from clients import get_qdrant, qdrant_uses_grpc
 
 # --- 設定 ---
-load_dotenv()
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
 COLLECTION_NAME = "taiwan_food_menu"
 VECTOR_SIZE = 768
+EMBEDDING_MODEL = "models/text-embedding-004"
+
+# Gemini 的批次 embedding 單次最多接受 100 筆內容
+EMBEDDING_BATCH_SIZE = 100
+EMBEDDING_MAX_WORKERS = 8
+
+# 資料庫讀取設定：分批讀取，每批讀完就轉換向量並上傳，
+# 每批的數量剛好讓每個執行緒各送出一個 embedding 請求
+DB_FETCH_SIZE = EMBEDDING_BATCH_SIZE * EMBEDDING_MAX_WORKERS
+
+# Qdrant 上傳設定：分批並行上傳到暫存 Collection，並在上傳期間暫停建立索引，
+# 上傳完成後再一次性建立 HNSW 索引並切換別名
+UPLOAD_BATCH_SIZE = 256
+UPLOAD_PARALLEL = 4
+INDEXING_THRESHOLD = 20000
+UPLOAD_TIMEOUT_SECONDS = 60
+UPLOAD_APPLY_TIMEOUT_SECONDS = 600 # 上傳使用 wait=False，切換別名前最多等待 Qdrant 套用完所有資料點的時間
+UPLOAD_APPLY_POLL_SECONDS = 2
 
 # --- 通用資料庫連線邏輯 ---
 
@@ -88,10 +106,160 @@ def get_db_connection():
     print(f"正在嘗試連線到資料庫，類型: {db_type.upper()}")
     return connector_func()
 
+# --- 向量轉換 ---
+
+def _chunks(items, size):
+    """將列表切成固定大小的區塊。"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _embed_chunk(chunk):
+    result = genai.embed_content(
+        model=EMBEDDING_MODEL,
+        content=chunk,
+        task_type="RETRIEVAL_DOCUMENT"
+    )
+    return result['embedding']
+
+def embed_items(items):
+    """
+    將菜名分批並行送到 Gemini 轉換為向量。
+    回傳的向量順序與輸入的菜名順序相同。
+    """
+    with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+        chunk_results = executor.map(_embed_chunk, _chunks(items, EMBEDDING_BATCH_SIZE))
+        return [vector for vectors in chunk_results for vector in vectors]
+
+# --- Qdrant 上傳 ---
+
+def upload_points(qdrant_client, collection_name, items, embeddings, start_id):
+    """
+    將菜名與向量分批並行上傳至指定的 Collection，資料點 id 從 start_id 開始。
+    使用 gRPC 時直接建立原生 gRPC 結構並呼叫 Upsert，略過 models.PointStruct 逐筆的 pydantic 驗證；
+    Client 改用 REST 時 (gRPC 連接埠不可用或 QDRANT_PREFER_GRPC=false) 則使用 upload_points。
+    """
+    ids = range(start_id, start_id + len(items))
+    if not qdrant_uses_grpc():
+        qdrant_client.upload_points(
+            collection_name=collection_name,
+            points=[
+                models.PointStruct(id=i, vector=vector.tolist(), payload={"item_name": name})
+                for i, name, vector in zip(ids, items, embeddings)
+            ],
+            batch_size=UPLOAD_BATCH_SIZE, parallel=UPLOAD_PARALLEL, wait=False
+        )
+        return
+
+    points = [
+        grpc.PointStruct(
+            id=grpc.PointId(num=i),
+            vectors=grpc.Vectors(vector=grpc.Vector(dense=grpc.DenseVector(data=vector.tolist()))),
+            payload={"item_name": grpc.Value(string_value=name)}
+        ) for i, name, vector in zip(ids, items, embeddings)
+    ]
+
+    def _upsert(batch):
+        # 原生 stub 沒有預設逾時，需自行指定，避免卡住的 RPC 讓執行緒永遠等待
+        qdrant_client.grpc_points.Upsert(
+            grpc.UpsertPoints(collection_name=collection_name, points=batch, wait=False),
+            timeout=UPLOAD_TIMEOUT_SECONDS
+        )
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_PARALLEL) as executor:
+        list(executor.map(_upsert, _chunks(points, UPLOAD_BATCH_SIZE)))
+
 # --- 主要遷移邏輯 ---
 
+def _iter_item_batches(cursor, size):
+    """
+    以 fetchmany 分批串流讀取菜名。
+    不使用 fetchall，避免一次把整張表載入記憶體。
+    """
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield [row[0] for row in rows]
+
+def _create_staging_collection():
+    """
+    建立這次遷移專用的暫存 Collection，回傳 (qdrant_client, 暫存名稱)，失敗時回傳 (None, None)。
+    全部上傳完成前都不會動到線上的 COLLECTION_NAME。
+    """
+    print("正在連線到 Qdrant...")
+    qdrant_client = get_qdrant()
+    if not qdrant_client:
+        return None, None
+
+    staging_name = f"{COLLECTION_NAME}_{int(time.time())}"
+    try:
+        print(f"正在建立暫存 Collection '{staging_name}'...")
+        qdrant_client.create_collection(
+            collection_name=staging_name,
+            vectors_config=models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.DOT),
+            optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0),
+            # int8 純量量化：向量儲存縮小為 1/4 並常駐記憶體，搜尋時再以原始向量重新評分
+            quantization_config=models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+            ),
+        )
+        print(f"暫存 Collection '{staging_name}' 已建立。")
+        return qdrant_client, staging_name
+    except Exception as e:
+        print(f"Qdrant 操作失敗: {e}")
+        return None, None
+
+def _wait_for_points(qdrant_client, staging_name, expected):
+    """
+    上傳時使用 wait=False，請求回傳只代表 Qdrant 已接收，不代表已寫入。
+    切換別名前確認暫存 Collection 的資料點數量等於上傳數量，逾時仍不相符時拋出例外，視為遷移失敗。
+    """
+    deadline = time.monotonic() + UPLOAD_APPLY_TIMEOUT_SECONDS
+    while True:
+        count = qdrant_client.count(collection_name=staging_name, exact=True).count
+        if count == expected:
+            return
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"暫存 Collection '{staging_name}' 只有 {count} 個資料點，預期 {expected} 個")
+        time.sleep(UPLOAD_APPLY_POLL_SECONDS)
+
+def _publish_collection(qdrant_client, staging_name):
+    """
+    恢復建立索引讓 Qdrant 一次建好 HNSW，再將別名 COLLECTION_NAME 原子地切換到新的 Collection，
+    最後刪除舊的 Collection。搜尋端一律透過別名查詢，切換過程中不會讀到不完整的資料。
+    """
+    qdrant_client.update_collection(
+        collection_name=staging_name,
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+    )
+    aliases = {alias.alias_name: alias.collection_name for alias in qdrant_client.get_aliases().aliases}
+    old_collection = aliases.get(COLLECTION_NAME)
+    operations = []
+    if old_collection:
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=COLLECTION_NAME)))
+    elif qdrant_client.collection_exists(COLLECTION_NAME):
+        # 舊版遷移直接建立了同名的 Collection，別名不能與 Collection 同名，只能先刪除 (只有第一次切換時會短暫無法搜尋)
+        qdrant_client.delete_collection(COLLECTION_NAME)
+    operations.append(models.CreateAliasOperation(
+        create_alias=models.CreateAlias(collection_name=staging_name, alias_name=COLLECTION_NAME)
+    ))
+    qdrant_client.update_collection_aliases(change_aliases_operations=operations)
+    print(f"別名 '{COLLECTION_NAME}' 已切換到 '{staging_name}'。")
+
+    if old_collection:
+        qdrant_client.delete_collection(old_collection)
+        print(f"已刪除舊的 Collection '{old_collection}'。")
+
+def _drop_staging_collection(qdrant_client, staging_name):
+    """遷移失敗時刪除暫存 Collection。"""
+    try:
+        qdrant_client.delete_collection(staging_name)
+        print(f"遷移未完成，已刪除暫存 Collection '{staging_name}'，線上資料維持不變。")
+    except Exception as e:
+        print(f"刪除暫存 Collection '{staging_name}' 失敗，請手動刪除: {e}")
+
 def migrate_data():
-    """從指定的資料庫讀取資料，產生向量，並儲存到 Qdrant。"""
+    """從指定的資料庫分批讀取資料，產生向量並儲存到暫存 Collection，全部成功後才切換上線。"""
     # 1. 設定 Gemini
     print("正在設定 Gemini API...")
     try:
@@ -104,72 +272,63 @@ def migrate_data():
     db_connection = get_db_connection()
     if not db_connection:
         return
-        
-    # 3. 從 menu_items 資料表取得不重複的菜名
-    print("正在從資料庫取得不重複的菜名...")
-    cursor = db_connection.cursor()
-    cursor.execute("SELECT DISTINCT item_name FROM menu_items;")
-    unique_items = [item[0] for item in cursor.fetchall()]
-    db_connection.close()
-    print(f"找到 {len(unique_items)} 個不重複的菜名。")
-    if not unique_items:
-        print("資料庫中沒有找到任何菜名，程式結束。")
-        return
 
-    # 4. 使用 Gemini 將菜名批次轉換為向量
-    print("正在使用 Gemini 將菜名轉換為向量...")
+    qdrant_client, staging_name = None, None
+    published = False
+    total_points = 0
     try:
-        result = genai.embed_content(
-            model="models/text-embedding-004",
-            content=unique_items,
-            task_type="RETRIEVAL_DOCUMENT"
-        )
-        embeddings = result['embedding']
-        print("向量轉換成功。")
-    except Exception as e:
-        print(f"Gemini 向量轉換失敗: {e}")
-        return
+        # 3. 從 menu_items 資料表分批讀取不重複的菜名
+        # MySQL 的 cursor 預設即為非緩衝，pyodbc 則以 fetchmany 分批取得
+        print("正在從資料庫分批讀取不重複的菜名...")
+        cursor = db_connection.cursor()
+        cursor.execute("SELECT DISTINCT item_name FROM menu_items;")
 
-    # 5. 連線到 Qdrant 並清空/重建 Collection
-    print("正在連線到 Qdrant...")
-    try:
-        qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-        
-        # 使用 recreate_collection 來確保每次執行都是從一個乾淨的狀態開始。
-        # 這個指令會先刪除同名的舊 Collection (如果存在)，然後再建立一個新的。
-        # 這完全符合「先清掉資料，再重新寫入」的需求。
-        print(f"正在清空並重建 Qdrant Collection '{COLLECTION_NAME}'...")
-        qdrant_client.recreate_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=models.VectorParams(size=VECTOR_SIZE, distance=models.Distance.COSINE),
-        )
-        print(f"Collection '{COLLECTION_NAME}' 已成功清空並重建。")
-    except Exception as e:
-        print(f"Qdrant 操作失敗: {e}")
-        return
+        for items in _iter_item_batches(cursor, DB_FETCH_SIZE):
+            # 4. 使用 Gemini 將這一批菜名轉換為向量
+            print(f"正在使用 Gemini 將 {len(items)} 個菜名轉換為向量...")
+            try:
+                # 以 float32 矩陣保存向量，比 Python float 列表省下數倍記憶體
+                embeddings = np.asarray(embed_items(items), dtype=np.float32)
+                # 預先正規化為單位向量，Collection 使用 DOT 距離，Qdrant 搜尋時不必再做餘弦正規化
+                embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            except Exception as e:
+                print(f"Gemini 向量轉換失敗: {e}")
+                return
 
-    # 6. 準備資料點並批次上傳至 Qdrant
-    print("正在準備資料點並上傳至 Qdrant...")
-    points_to_upsert = [
-        models.PointStruct(
-            id=str(uuid.uuid4()),
-            vector=embeddings[i],
-            payload={"item_name": item_name}
-        ) for i, item_name in enumerate(unique_items)
-    ]
-    
-    try:
-        qdrant_client.upsert(
-            collection_name=COLLECTION_NAME,
-            points=points_to_upsert,
-            wait=True
-        )
-        print(f"成功上傳 {len(points_to_upsert)} 個資料點至 Qdrant。")
-    except Exception as e:
-        print(f"上傳資料至 Qdrant 失敗: {e}")
-        return
+            # 5. 讀到第一批菜名後才建立暫存 Collection，資料庫沒有資料時不會動到 Qdrant
+            if staging_name is None:
+                qdrant_client, staging_name = _create_staging_collection()
+                if staging_name is None:
+                    return
+
+            # 6. 準備資料點並批次上傳至暫存 Collection
+            try:
+                upload_points(qdrant_client, staging_name, items, embeddings, total_points)
+            except Exception as e:
+                print(f"上傳資料至 Qdrant 失敗: {e}")
+                return
+            total_points += len(items)
+            print(f"已上傳 {total_points} 個資料點至 Qdrant。")
+
+        if staging_name is None:
+            print("資料庫中沒有找到任何菜名，程式結束。")
+            return
+
+        # 7. 全部上傳成功後才恢復建立索引並切換別名
+        try:
+            _wait_for_points(qdrant_client, staging_name, total_points)
+            _publish_collection(qdrant_client, staging_name)
+            published = True
+        except Exception as e:
+            print(f"切換 Collection 失敗: {e}")
+            return
+    finally:
+        db_connection.close()
+        # 任何一步失敗都刪除暫存 Collection，線上的 COLLECTION_NAME 維持遷移前的狀態
+        if staging_name and not published:
+            _drop_staging_collection(qdrant_client, staging_name)
 
-    print("\n資料遷移完成！")
+    print(f"\n資料遷移完成！共 {total_points} 個資料點。")
 
 if __name__ == "__main__":
     migrate_data()
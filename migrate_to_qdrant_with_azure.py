@@ -1,31 +1,47 @@
 import os
-import uuid
+import json
+import time
+import hashlib
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pyodbc
 import mysql.connector
-from openai import AzureOpenAI
-from qdrant_client import QdrantClient, models
-from dotenv import load_dotenv
+from qdrant_client import grpc, models
+# Azure OpenAI 與 Qdrant 的設定與 Client 與 app.py 共用 clients.py (匯入時會載入 .env)
+from clients import AZURE_OPENAI_EMBEDDING_DEPLOYMENT, get_openai, get_qdrant, qdrant_uses_grpc
 
 # --- 設定 ---
-load_dotenv()
+COLLECTION_NAME = "taiwan_food_menu_azure"
 
-# Azure OpenAI 設定
-AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-AZURE_OPENAI_API_KEY = os.getenv("AZURE_OPENAI_API_KEY")
-AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
-AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION")
+# 向量轉換設定：每次請求的菜名數量需低於 Azure 的單次輸入上限 (2048 筆)
+EMBEDDING_BATCH_SIZE = 512
+EMBEDDING_MAX_WORKERS = 8
 
-# Qdrant 設定
-QDRANT_URL = os.getenv("QDRANT_URL")
-QDRANT_API_KEY = os.getenv("QDRANT_API_KEY")
-COLLECTION_NAME = "taiwan_food_menu_azure"
+# Batch API 設定：遷移可以等待，改走 Batch API 成本約為線上 API 的一半 (24 小時內完成)
+# Batch API 需要 Global Batch 類型的部署，未另外指定時沿用 embedding 的部署名稱
+AZURE_OPENAI_USE_BATCH = os.getenv("AZURE_OPENAI_USE_BATCH", "false").lower() == "true"
+AZURE_OPENAI_BATCH_DEPLOYMENT = os.getenv("AZURE_OPENAI_BATCH_DEPLOYMENT", AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+BATCH_EMBEDDINGS_URL = "/embeddings"
+BATCH_POLL_INTERVAL_SECONDS = 60
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+BATCH_MAX_REQUESTS = 100000 # 單一 Batch 工作的請求上限，菜名超過時才拆成多個工作
+
+# 向量快取設定：以 sha256(部署名稱 + 菜名) 為 key，重複執行時只轉換新的菜名
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "emb_cache.sqlite")
+EMBEDDING_CACHE_QUERY_SIZE = 500 # 單次 SELECT ... IN (...) 的 key 數量，需低於 sqlite 的參數上限
+
+# 資料庫讀取設定：分批讀取，每批讀完就轉換向量並上傳，不必一次把整張表載入記憶體
+DB_FETCH_SIZE = EMBEDDING_BATCH_SIZE * EMBEDDING_MAX_WORKERS # 每批剛好讓每個執行緒各送出一個請求
 
-# 初始化 Azure OpenAI Client
-openai_client = AzureOpenAI(
-    api_key=AZURE_OPENAI_API_KEY,
-    api_version=AZURE_OPENAI_API_VERSION,
-    azure_endpoint=AZURE_OPENAI_ENDPOINT
-)
+# Qdrant 上傳設定：先上傳到暫存 Collection，上傳期間暫停建立索引，完成後再一次建立 HNSW 並切換別名
+UPLOAD_BATCH_SIZE = 256
+UPLOAD_PARALLEL = 4
+INDEXING_THRESHOLD = 20000
+UPLOAD_TIMEOUT_SECONDS = 60
+UPLOAD_APPLY_TIMEOUT_SECONDS = 600 # 上傳使用 wait=False，切換別名前最多等待 Qdrant 套用完所有資料點的時間
+UPLOAD_APPLY_POLL_SECONDS = 2
 
 # --- 通用資料庫連線邏輯 ---
 def _connect_sql_server():
@@ -68,62 +84,270 @@ def get_db_connection():
     print(f"正在嘗試連線到資料庫，類型: {db_type.upper()}")
     return connector_func()
 
-# --- 主要遷移邏輯 ---
-def migrate_data():
-    """從資料庫讀取資料，用 Azure OpenAI 產生向量，並上傳到 Qdrant。"""
-    
-    # 1. 從資料庫取得菜名
-    db_connection = get_db_connection()
-    if not db_connection: return
-    
-    print("正在從資料庫取得不重複的菜名...")
-    cursor = db_connection.cursor()
-    cursor.execute("SELECT DISTINCT item_name FROM menu_items;")
-    unique_items = [item[0] for item in cursor.fetchall()]
-    db_connection.close()
-    print(f"找到 {len(unique_items)} 個不重複的菜名。")
-    if not unique_items: return
-
-    # 2. 使用 Azure OpenAI 將菜名轉換為向量
-    print("正在使用 Azure OpenAI 將菜名轉換為向量...")
-    try:
-        response = openai_client.embeddings.create(input=unique_items, model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
-        embeddings = [item.embedding for item in response.data]
-        # 取得向量維度，例如 text-embedding-ada-002 是 1536
-        vector_size = len(embeddings[0])
-        print(f"向量轉換成功，維度: {vector_size}。")
-    except Exception as e:
-        print(f"Azure OpenAI 向量轉換失敗: {e}")
+# --- 向量轉換 ---
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _embed_chunk(chunk):
+    response = get_openai().embeddings.create(input=chunk, model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+    return [item.embedding for item in response.data]
+
+def embed_items(items):
+    """將菜名分批並行送到 Azure OpenAI，回傳與輸入順序相同的向量列表。"""
+    with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_WORKERS) as executor:
+        chunk_results = executor.map(_embed_chunk, _chunks(items, EMBEDDING_BATCH_SIZE))
+        return [vector for vectors in chunk_results for vector in vectors]
+
+def embed_items_with_batch_api(items):
+    """將菜名寫成 JSONL 送到 Azure OpenAI Batch API，等待完成後依 custom_id 還原順序。"""
+    openai_client = get_openai()
+    lines = [
+        json.dumps({
+            "custom_id": str(i), "method": "POST", "url": BATCH_EMBEDDINGS_URL,
+            "body": {"model": AZURE_OPENAI_BATCH_DEPLOYMENT, "input": name}
+        }, ensure_ascii=False)
+        for i, name in enumerate(items)
+    ]
+    batch_file = openai_client.files.create(file=("embeddings.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+    batch = openai_client.batches.create(input_file_id=batch_file.id, endpoint=BATCH_EMBEDDINGS_URL, completion_window="24h")
+    print(f"已送出 Batch 工作 {batch.id}，等待完成...")
+
+    while batch.status not in BATCH_TERMINAL_STATUSES:
+        time.sleep(BATCH_POLL_INTERVAL_SECONDS)
+        batch = openai_client.batches.retrieve(batch.id)
+        print(f"Batch 工作狀態: {batch.status}")
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch 工作未成功完成，狀態: {batch.status}")
+
+    embeddings = [None] * len(items)
+    for line in openai_client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            raise RuntimeError(f"第 {result['custom_id']} 筆菜名轉換失敗: {result.get('error') or response.get('body')}")
+        embeddings[int(result["custom_id"])] = response["body"]["data"][0]["embedding"]
+
+    missing = sum(1 for vector in embeddings if vector is None)
+    if missing:
+        raise RuntimeError(f"Batch 結果缺少 {missing} 筆向量，請查看錯誤檔案 {batch.error_file_id}")
+    return embeddings
+
+def _embedding_cache_key(deployment, name):
+    return hashlib.sha256(f"{deployment}\x1f{name}".encode("utf-8")).hexdigest()
+
+def embed_items_with_cache(items, embed_func, deployment):
+    """
+    先查詢本機 sqlite 快取，只把快取中沒有的菜名交給 embed_func 轉換，回傳與輸入順序相同的 float32 向量矩陣。
+    deployment 必須是 embed_func 實際使用的部署，不同部署可能是不同模型，向量不能混用。
+    """
+    keys = [_embedding_cache_key(deployment, name) for name in items]
+    with closing(sqlite3.connect(EMBEDDING_CACHE_PATH)) as cache_db:
+        cache_db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+        vectors_by_key = {}
+        for start in range(0, len(keys), EMBEDDING_CACHE_QUERY_SIZE):
+            key_chunk = keys[start:start + EMBEDDING_CACHE_QUERY_SIZE]
+            rows = cache_db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(key_chunk))})", key_chunk
+            )
+            vectors_by_key.update((key, np.frombuffer(vector, dtype=np.float32)) for key, vector in rows)
+
+        to_embed = [(key, name) for key, name in zip(keys, items) if key not in vectors_by_key]
+        print(f"向量快取命中 {len(items) - len(to_embed)} 筆，需要轉換 {len(to_embed)} 筆。")
+        if to_embed:
+            new_vectors = np.asarray(embed_func([name for _, name in to_embed]), dtype=np.float32)
+            cache_db.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, vector.tobytes()) for (key, _), vector in zip(to_embed, new_vectors)]
+            )
+            cache_db.commit()
+            vectors_by_key.update((key, vector) for (key, _), vector in zip(to_embed, new_vectors))
+
+    return np.stack([vectors_by_key[key] for key in keys])
+
+# --- Qdrant 上傳 ---
+def upload_points(qdrant_client, collection_name, items, embeddings, start_id):
+    """分批並行上傳資料點：gRPC 可用時直接送出原生 gRPC 結構，略過 pydantic 驗證；否則改用 REST 的 upload_points。"""
+    ids = range(start_id, start_id + len(items))
+    if not qdrant_uses_grpc():
+        qdrant_client.upload_points(
+            collection_name=collection_name,
+            points=[
+                models.PointStruct(id=i, vector=vector.tolist(), payload={"item_name": name})
+                for i, name, vector in zip(ids, items, embeddings)
+            ],
+            batch_size=UPLOAD_BATCH_SIZE, parallel=UPLOAD_PARALLEL, wait=False
+        )
         return
 
-    # 3. 連線到 Qdrant 並清空/重建 Collection
-    print("正在連線到 Qdrant 並準備 Collection...")
+    points = [
+        grpc.PointStruct(
+            id=grpc.PointId(num=i),
+            vectors=grpc.Vectors(vector=grpc.Vector(dense=grpc.DenseVector(data=vector.tolist()))),
+            payload={"item_name": grpc.Value(string_value=name)}
+        ) for i, name, vector in zip(ids, items, embeddings)
+    ]
+
+    def _upsert(batch):
+        # 原生 stub 沒有預設逾時，需自行指定，避免卡住的 RPC 讓執行緒永遠等待
+        qdrant_client.grpc_points.Upsert(
+            grpc.UpsertPoints(collection_name=collection_name, points=batch, wait=False),
+            timeout=UPLOAD_TIMEOUT_SECONDS
+        )
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_PARALLEL) as executor:
+        list(executor.map(_upsert, _chunks(points, UPLOAD_BATCH_SIZE)))
+
+# --- 主要遷移邏輯 ---
+def _iter_item_batches(cursor, size):
+    """以 fetchmany 分批串流讀取菜名，不必用 fetchall 一次把整張表載入記憶體。"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield [row[0] for row in rows]
+
+def _create_staging_collection(vector_size):
+    """建立這次遷移專用的暫存 Collection，全部上傳完成前都不會動到線上的 COLLECTION_NAME。"""
+    print("正在連線到 Qdrant 並準備暫存 Collection...")
+    qdrant_client = get_qdrant()
+    if not qdrant_client: return None, None
+    staging_name = f"{COLLECTION_NAME}_{int(time.time())}"
     try:
-        qdrant_client = QdrantClient(url=QDRANT_URL, api_key=QDRANT_API_KEY)
-        qdrant_client.recreate_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.COSINE),
+        qdrant_client.create_collection(
+            collection_name=staging_name,
+            vectors_config=models.VectorParams(size=vector_size, distance=models.Distance.DOT),
+            optimizers_config=models.OptimizersConfigDiff(indexing_threshold=0),
+            # int8 純量量化：向量儲存縮小為 1/4 並常駐記憶體，搜尋時再以原始向量重新評分
+            quantization_config=models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+            ),
         )
-        print(f"Collection '{COLLECTION_NAME}' 已成功清空並重建。")
+        print(f"暫存 Collection '{staging_name}' 已建立。")
+        return qdrant_client, staging_name
     except Exception as e:
         print(f"Qdrant 操作失敗: {e}")
-        return
+        return None, None
 
-    # 4. 準備資料點並上傳至 Qdrant
-    print("正在準備資料點並上傳至 Qdrant...")
-    points_to_upsert = [
-        models.PointStruct(id=str(uuid.uuid4()), vector=vector, payload={"item_name": name})
-        for name, vector in zip(unique_items, embeddings)
-    ]
-    
+def _wait_for_points(qdrant_client, staging_name, expected):
+    """
+    上傳時使用 wait=False，請求回傳只代表 Qdrant 已接收，不代表已寫入。
+    切換別名前確認暫存 Collection 的資料點數量等於上傳數量，逾時仍不相符時拋出例外，視為遷移失敗。
+    """
+    deadline = time.monotonic() + UPLOAD_APPLY_TIMEOUT_SECONDS
+    while True:
+        count = qdrant_client.count(collection_name=staging_name, exact=True).count
+        if count == expected:
+            return
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"暫存 Collection '{staging_name}' 只有 {count} 個資料點，預期 {expected} 個")
+        time.sleep(UPLOAD_APPLY_POLL_SECONDS)
+
+def _publish_collection(qdrant_client, staging_name):
+    """恢復建立索引後，將別名 COLLECTION_NAME 原子地切換到新的 Collection，再刪除舊的 Collection。"""
+    qdrant_client.update_collection(
+        collection_name=staging_name,
+        optimizers_config=models.OptimizersConfigDiff(indexing_threshold=INDEXING_THRESHOLD)
+    )
+    aliases = {alias.alias_name: alias.collection_name for alias in qdrant_client.get_aliases().aliases}
+    old_collection = aliases.get(COLLECTION_NAME)
+    operations = []
+    if old_collection:
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=COLLECTION_NAME)))
+    elif qdrant_client.collection_exists(COLLECTION_NAME):
+        # 舊版遷移直接建立了同名的 Collection，別名不能與 Collection 同名，只能先刪除 (只有第一次切換時會短暫無法搜尋)
+        qdrant_client.delete_collection(COLLECTION_NAME)
+    operations.append(models.CreateAliasOperation(
+        create_alias=models.CreateAlias(collection_name=staging_name, alias_name=COLLECTION_NAME)
+    ))
+    qdrant_client.update_collection_aliases(change_aliases_operations=operations)
+    print(f"別名 '{COLLECTION_NAME}' 已切換到 '{staging_name}'。")
+    if old_collection:
+        qdrant_client.delete_collection(old_collection)
+        print(f"已刪除舊的 Collection '{old_collection}'。")
+
+def _drop_staging_collection(qdrant_client, staging_name):
     try:
-        qdrant_client.upsert(collection_name=COLLECTION_NAME, points=points_to_upsert, wait=True)
-        print(f"成功上傳 {len(points_to_upsert)} 個資料點至 Qdrant。")
+        qdrant_client.delete_collection(staging_name)
+        print(f"遷移未完成，已刪除暫存 Collection '{staging_name}'，線上資料維持不變。")
     except Exception as e:
-        print(f"上傳資料至 Qdrant 失敗: {e}")
-        return
+        print(f"刪除暫存 Collection '{staging_name}' 失敗，請手動刪除: {e}")
+
+def migrate_data():
+    """從資料庫分批讀取菜名，用 Azure OpenAI 產生向量並上傳到暫存 Collection，全部成功後才切換上線。"""
+    
+    if not get_openai(): return
+
+    # 1. 從資料庫讀取菜名：線上 API 以串流分批讀取 (MySQL 的 cursor 預設即為非緩衝，pyodbc 則以 fetchmany 分批取得)；
+    #    Batch API 的工作可能要等待數小時，因此先一次讀完菜名並關閉連線，再送出單一工作
+    db_connection = get_db_connection()
+    if not db_connection: return
+
+    embed_func = embed_items_with_batch_api if AZURE_OPENAI_USE_BATCH else embed_items
+    embed_deployment = AZURE_OPENAI_BATCH_DEPLOYMENT if AZURE_OPENAI_USE_BATCH else AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+    qdrant_client, staging_name = None, None
+    published = False
+    total_points = 0
+    try:
+        print("正在從資料庫讀取不重複的菜名...")
+        cursor = db_connection.cursor()
+        cursor.execute("SELECT DISTINCT item_name FROM menu_items;")
+        if AZURE_OPENAI_USE_BATCH:
+            # 菜名本身很小，佔記憶體的是向量；關閉連線後才送出工作，等待期間不佔用資料庫連線
+            all_items = [row[0] for row in cursor.fetchall()]
+            db_connection.close()
+            db_connection = None
+            item_batches = _chunks(all_items, BATCH_MAX_REQUESTS)
+        else:
+            item_batches = _iter_item_batches(cursor, DB_FETCH_SIZE)
+
+        for items in item_batches:
+            # 2. 使用 Azure OpenAI 將這一批菜名轉換為向量
+            print(f"正在使用 Azure OpenAI {'Batch API' if AZURE_OPENAI_USE_BATCH else ''}將 {len(items)} 個菜名轉換為向量...")
+            try:
+                embeddings = embed_items_with_cache(items, embed_func, embed_deployment)
+                # 預先正規化為單位向量，Collection 使用 DOT 距離，Qdrant 搜尋時不必再做餘弦正規化
+                embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            except Exception as e:
+                print(f"Azure OpenAI 向量轉換失敗: {e}")
+                return
+
+            # 3. 取得第一批向量的維度後 (例如 text-embedding-ada-002 是 1536)，建立暫存 Collection
+            if staging_name is None:
+                print(f"向量維度: {embeddings.shape[1]}。")
+                qdrant_client, staging_name = _create_staging_collection(embeddings.shape[1])
+                if staging_name is None: return
+
+            # 4. 準備資料點並上傳至暫存 Collection
+            try:
+                upload_points(qdrant_client, staging_name, items, embeddings, total_points)
+            except Exception as e:
+                print(f"上傳資料至 Qdrant 失敗: {e}")
+                return
+            total_points += len(items)
+            print(f"已上傳 {total_points} 個資料點至 Qdrant。")
+
+        if staging_name is None:
+            print("資料庫中沒有找到任何菜名。")
+            return
+
+        # 5. 全部上傳成功後恢復建立索引，讓 Qdrant 一次建好 HNSW，再把別名切換到新的 Collection
+        try:
+            _wait_for_points(qdrant_client, staging_name, total_points)
+            _publish_collection(qdrant_client, staging_name)
+            published = True
+        except Exception as e:
+            print(f"切換 Collection 失敗: {e}")
+            return
+    finally:
+        if db_connection: db_connection.close()
+        # 任何一步失敗都刪除暫存 Collection，線上的 COLLECTION_NAME 維持遷移前的狀態
+        if staging_name and not published:
+            _drop_staging_collection(qdrant_client, staging_name)
 
-    print("\n資料遷移至 Qdrant 完成！")
+    print(f"\n資料遷移至 Qdrant 完成！共 {total_points} 個資料點。")
 
 if __name__ == "__main__":
     migrate_data()